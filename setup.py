@@ -12,7 +12,13 @@ setup(
         packages=find_packages(),
         install_requires=[
             'requests',
+            'requests_toolbelt',
         ],
+        extras_require={
+            'async': ['aiohttp'],
+            'orjson': ['orjson'],
+            'zstd': ['zstandard'],
+        },
         license='GPLv2+',
         classifiers=[
             'License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)',
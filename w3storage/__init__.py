@@ -1,22 +1,51 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import asyncio
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
+import io
+import json
 import requests
-
-class _BearerAuth(requests.auth.AuthBase):
-    def __init__(self, key):
-        self.key = key
-    def __call__(self, r):
-        r.headers['authorization'] = 'Bearer ' + self.key
-        return r
+import shutil
+import zlib
+from requests_toolbelt import MultipartEncoder
+from urllib.parse import quote
+from urllib3.exceptions import UnrewindableBodyError
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
 
 class W3Exception(Exception):
     def __init__(self, response, *params):
-        try:
-            json = response.json()
-            params = (json['name'], json['message'], *params)
-        except:
-            params = (response.text, *params)
+        # response is None when the request failed without one to report
+        if response is not None:
+            try:
+                body = _loads(response.content)
+                params = (body['name'], body['message'], *params)
+            except (ValueError, KeyError, TypeError):
+                # decoding directly avoids requests' charset detection
+                try:
+                    text = response.content.decode('utf-8', 'replace')
+                except Exception:
+                    text = '<binary body>'
+                params = (text, *params)
         super().__init__(*params)
 
 class W3BadRequest(W3Exception):
@@ -43,10 +72,56 @@ all the return objects.
 '''
 
 class API:
+    _USER_UPLOADS_PATH = 'user/uploads'
+    _USER_UPLOADS_DEFAULT_SIZE = 25
+    _CACHE_SIZE = 4096
+    _POOL_SIZE = 20
+
     def __init__(self, token = None, url = 'https://api.web3.storage'):
-        self._url = url
-        self._auth = _BearerAuth(token) if token is not None else None
-    def post_car(self, car, name=None):
+        self._url = url.rstrip('/')
+        self._upload_encodings = None
+        # content-addressed data does not change, so sizes may be cached
+        self._cached_head_car = functools.lru_cache(maxsize=self._CACHE_SIZE)(self._head_car)
+        self._status_cache = collections.OrderedDict()
+        self._session = requests.Session()
+        if token is not None:
+            # a fixed header skips the per-request auth hook
+            self._session.headers['authorization'] = 'Bearer ' + token
+        self._session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections = 4,
+            pool_maxsize = self._POOL_SIZE,
+            max_retries = 0
+        ))
+        # transient server errors are retried inside the adapter, over the
+        # already-open connection
+        self._session.mount(self._url, requests.adapters.HTTPAdapter(
+            pool_connections = 4,
+            pool_maxsize = self._POOL_SIZE,
+            max_retries = Retry(
+                total = 5,
+                backoff_factor = 0.2,
+                status_forcelist = (429, 500, 502, 503, 504),
+                allowed_methods = frozenset(('HEAD', 'GET', 'POST')),
+                respect_retry_after_header = True,
+                raise_on_status = False
+            )
+        ))
+    def close(self):
+        '''
+        Release the pooled connections held by this API object.
+        '''
+        self._session.close()
+    def clear_cache(self):
+        '''
+        Forget the results cached by .head_car() and .status().
+        '''
+        self._cached_head_car.cache_clear()
+        self._status_cache.clear()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+    def post_car(self, car, name=None, chunk_size=None, compress=None, name_is_quoted=False):
         '''
         Upload a CAR[1] (Content Addressable aRchive) file and store the IPFS
         DAG[2] (Directed Acyclic Graph) it contains.
@@ -65,7 +140,16 @@ class API:
         multiple files at once and accepts both CAR files and files from the
         client.
 
-        You can also provide a name for the file.
+        You can also provide a name for the file. It is percent-encoded
+        unless name_is_quoted is passed as True.
+
+        car may be bytes or a file object opened in binary mode, which is
+        streamed rather than read into memory. chunk_size sets the size of
+        the reads made from it while sending.
+
+        compress may be 'gzip' or 'zstd' to compress the CAR while sending it,
+        if the server advertises support for that encoding. Otherwise it is
+        sent uncompressed. 'zstd' requires the zstandard package.
 
         Returns: CID of upload as str.
 
@@ -78,13 +162,25 @@ class API:
         '''
         headers = {}
         if name is not None:
-            headers['X-NAME'] = requests.utils.quote(name)
+            headers['X-NAME'] = name if name_is_quoted else quote(name, safe='')
+        if compress is not None:
+            if compress not in ('gzip', 'zstd'):
+                raise ValueError('unsupported compression', compress)
+            if compress == 'zstd' and zstandard is None:
+                raise ImportError('zstd compression requires zstandard')
+            if compress not in self._accepted_upload_encodings():
+                compress = None
+        if compress is not None:
+            car = _CompressedReader(car, compress, chunk_size)
+            headers['Content-Encoding'] = compress
+        elif chunk_size is not None and hasattr(car, 'read'):
+            car = _ChunkedReader(car, chunk_size)
         r = self._post(
             'upload',
             data = car,
             headers = headers
         )
-        return r.json()['cid']
+        return _loads(r.content)['cid']
 
     def car(self, cid):
         '''
@@ -95,8 +191,18 @@ class API:
 
         Returns: bytes
         '''
-        r = self._get('car', str(cid))
-        return r.content
+        fileobj = io.BytesIO()
+        self.car_to(cid, fileobj)
+        return fileobj.getvalue()
+
+    def car_to(self, cid, fileobj, chunk_size=1<<20):
+        '''
+        Like .car(), but write the CAR to the binary file object fileobj as it
+        is received, rather than holding it in memory.
+        '''
+        with self._get(f'car/{cid}', stream=True) as r:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, fileobj, chunk_size)
 
     def head_car(self, cid):
         '''
@@ -105,10 +211,24 @@ class API:
         lightweight and can be used to get only the metadata about the given
         CAR file without retrieving a whole payload.
 
+        Results are cached; see .clear_cache().
+
         Returns: int size of bytes
         '''
-        r = self._head('car', str(cid))
-        return int(r['Content-Length'])
+        return self._cached_head_car(str(cid))
+
+    def _head_car(self, cid):
+        r = self._head(f'car/{cid}')
+        return int(r.headers['Content-Length'])
+
+    def head_car_many(self, cids):
+        '''
+        Call .head_car() for each of cids, reusing one pooled connection.
+        AsyncAPI.head_car_many() issues these concurrently.
+
+        Returns: list of int sizes of bytes, in the order of cids.
+        '''
+        return [self.head_car(cid) for cid in cids]
 
     def status(self, cid):
         '''
@@ -148,13 +268,31 @@ class API:
             ]
         }
 
+        Once all pins are Pinned and a deal is Active, the result is cached;
+        see .clear_cache(). Each call returns a separate copy.
+
         1: https://ipfs.io/
         2: https://filecoin.io/
         '''
-        r = self._get('status', str(cid))
-        return r.json()
-
-    def post_upload(self, *files):
+        cid = str(cid)
+        result = self._status_cache.get(cid)
+        if result is not None:
+            self._status_cache.move_to_end(cid)
+            return copy.deepcopy(result)
+        r = self._get(f'status/{cid}')
+        result = _loads(r.content)
+        # only a status that has settled is cached, so polling a cid while
+        # it is being pinned still sees each update
+        if (
+            all(pin['status'] == 'Pinned' for pin in result.get('pins', ())) and
+            any(deal['status'] == 'Active' for deal in result.get('deals', ()))
+        ):
+            self._status_cache[cid] = copy.deepcopy(result)
+            if len(self._status_cache) > self._CACHE_SIZE:
+                self._status_cache.popitem(last=False)
+        return result
+
+    def post_upload(self, *files, chunk_size=None):
         '''
         Store files using Web3.Storage. You can upload either a single file or
         multiple files.
@@ -163,19 +301,57 @@ class API:
         optional_content_type, optional_headers). A file object opened in
         binary mode may be passed to read from the object.
 
+        The request body is streamed rather than assembled in memory, except
+        for file objects that cannot seek, such as pipes, which are read in
+        full first. chunk_size sets the size of the reads made from it while
+        sending.
+
         Requests to this endpoint have a maximum payload size of 100MB. To
         upload larger files, see the documentation for the .post_car().
 
         Returns: CID of upload as str
         '''
+        fields = []
+        try:
+            for file in files:
+                if type(file) is not tuple:
+                    file = (requests.utils.guess_filename(file) or 'file', file)
+                filename, filedata, *extra = file
+                if hasattr(filedata, 'read') and not _seekable(filedata):
+                    # the encoder needs the length of each part up front, so
+                    # a stream that cannot seek is read into memory
+                    filedata = filedata.read()
+                fields.append(('file', (filename, filedata, *extra)))
+            encoder = MultipartEncoder(fields)
+        except OSError as exception:
+            file_exception = exception
+        else:
+            file_exception = None
+        if file_exception is not None:
+            raise W3HTTPError(None, 'files could not be read for upload', file_exception)
         r = self._post(
             'upload',
-            files=[
-                ('file', file)
-                for file in files
-            ]
+            data = _ChunkedReader(encoder, chunk_size, _multipart_reencoder(fields, encoder)),
+            headers = {'Content-Type': encoder.content_type}
         )
-        return r.json()['cid']
+        return _loads(r.content)['cid']
+
+    def post_upload_parallel(self, files, max_workers=8):
+        '''
+        Upload each of files separately with .post_upload(), issuing up to
+        max_workers requests at once over the pooled connections.
+
+        Unlike .post_upload(), each file is stored under its own CID and the
+        100MB limit applies to each file rather than to the whole batch.
+
+        max_workers is limited to the size of the connection pool, 20, so that
+        every request reuses a pooled connection.
+
+        Returns: list of CIDs as str, in the order of files.
+        '''
+        max_workers = min(max_workers, self._POOL_SIZE)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.post_upload, files))
 
     def user_uploads(self, before: str = None, size: int = None):
         '''
@@ -202,6 +378,8 @@ class API:
             given date.
     
             Example: "2020-07-27T17:32:28Z"
+
+            A datetime or a unix timestamp may also be passed.
     
         size: int
 
@@ -244,42 +422,353 @@ class API:
         1: https://ipfs.io/
         2: https://filecoin.io/
         '''
-        params = {}
-        if before is not None:
-            if type(before) is int:
-                before = datetime.datetime.fromtimestamp()
-            elif type(before) is str:
-                before = datetime.datetime.fromisoformat(before)
-            before = before.isoformat()
-            params['before'] = before
-        if size is not None:
-            params['size'] = int(size)
-        r = self._get('user', 'uploads', params=params)
-        return r.json()
-
-    def _head(self, *params, **kwparams):
-        return self._request(*params, method='HEAD', **kwparams)
-    def _get(self, *params, **kwparams):
-        return self._request(*params, method='GET', **kwparams)
-    def _post(self, *params, **kwparams):
-        return self._request(*params, method='POST', **kwparams)
-    def _request(self, *params, **kwparams):
-        params = (self._url, *params)
-        if self._auth is not None and 'auth' not in kwparams:
-            kwparams['auth'] = self._auth
-        r = requests.request(url='/'.join(params), **kwparams)
+        r = self._get(self._USER_UPLOADS_PATH, params=_user_uploads_params(before, size))
+        return _loads(r.content)
+
+    def iter_user_uploads(self, before: str = None, size: int = 100):
+        '''
+        Iterate over all uploads for the account, newest first, paginating
+        .user_uploads() in pages of size. If size is None, the server's
+        default page size is used.
+
+        Each next page is fetched in the background while the items of the
+        current page are consumed.
+        '''
+        # a page shorter than this is the last
+        page_size = self._USER_UPLOADS_DEFAULT_SIZE if size is None else size
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            page = executor.submit(self.user_uploads, before, size)
+            while page is not None:
+                uploads = page.result()
+                if len(uploads) >= page_size:
+                    page = executor.submit(self.user_uploads, uploads[-1]['created'], size)
+                else:
+                    page = None
+                yield from uploads
+
+    def _accepted_upload_encodings(self):
+        # servers may list the content codings they accept for requests in
+        # the Accept-Encoding header of a response (RFC 7694)
+        if self._upload_encodings is None:
+            try:
+                r = self._session.options(f'{self._url}/upload')
+                encodings = r.headers.get('Accept-Encoding', '')
+            except requests.RequestException:
+                encodings = ''
+            self._upload_encodings = {
+                encoding.split(';')[0].strip().lower()
+                for encoding in encodings.split(',')
+            }
+        return self._upload_encodings
+
+    def _head(self, path, **kwparams):
+        return self._request(path, method='HEAD', **kwparams)
+    def _get(self, path, **kwparams):
+        return self._request(path, method='GET', **kwparams)
+    def _post(self, path, **kwparams):
+        return self._request(path, method='POST', **kwparams)
+    def _request(self, path, method, **kwparams):
+        try:
+            r = self._session.request(method, f'{self._url}/{path}', **kwparams)
+        except UnrewindableBodyError as exception:
+            # the adapter retried a failed request but could not resend its
+            # streamed body from the start
+            unrewindable_exception = exception
+        else:
+            unrewindable_exception = None
+        if unrewindable_exception is not None:
+            raise W3HTTPError(None, 'request body could not be rewound to retry', unrewindable_exception)
+        try:
+            r.raise_for_status()
+            return r
+        except Exception as exception:
+            http_exception = exception
+        _raise_w3_exception(r, http_exception)
+
+class AsyncAPI:
+    '''
+    An asyncio counterpart to API, built on aiohttp, for issuing many
+    requests concurrently over one connection pool.
+
+    The methods mirror those of API and are documented there.
+    '''
+    _USER_UPLOADS_PATH = API._USER_UPLOADS_PATH
+
+    def __init__(self, token = None, url = 'https://api.web3.storage'):
+        if aiohttp is None:
+            raise ImportError('AsyncAPI requires aiohttp')
+        self._url = url.rstrip('/')
+        self._headers = {}
+        if token is not None:
+            self._headers['authorization'] = 'Bearer ' + token
+        # the session is created on first use, inside the running event loop
+        self._session = None
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def post_car(self, car, name=None, name_is_quoted=False):
+        '''
+        See API.post_car().
+        '''
+        headers = {}
+        if name is not None:
+            headers['X-NAME'] = name if name_is_quoted else quote(name, safe='')
+        r = await self._post(
+            'upload',
+            data = car,
+            headers = headers
+        )
+        return _loads(r.content)['cid']
+
+    async def car(self, cid):
+        '''
+        See API.car().
+        '''
+        r = await self._get(f'car/{cid}')
+        return r.content
+
+    async def head_car(self, cid):
+        '''
+        See API.head_car().
+        '''
+        r = await self._head(f'car/{cid}')
+        return int(r.headers['Content-Length'])
+
+    async def head_car_many(self, cids):
+        '''
+        Concurrently retrieve .head_car() for each of cids.
+
+        Returns: list of int sizes of bytes, in the order of cids.
+        '''
+        return await asyncio.gather(*(self.head_car(cid) for cid in cids))
+
+    async def status(self, cid):
+        '''
+        See API.status().
+        '''
+        r = await self._get(f'status/{cid}')
+        return _loads(r.content)
+
+    async def status_many(self, cids):
+        '''
+        Concurrently retrieve .status() for each of cids.
+
+        Returns: list of status objects, in the order of cids.
+        '''
+        return await asyncio.gather(*(self.status(cid) for cid in cids))
+
+    async def post_upload(self, *files):
+        '''
+        See API.post_upload().
+        '''
+        data = aiohttp.MultipartWriter('form-data')
+        for file in files:
+            if type(file) is not tuple:
+                file = (requests.utils.guess_filename(file) or 'file', file)
+            filename, filedata, content_type, headers = (*file, None, None)[:4]
+            headers = dict(headers or {})
+            if content_type is not None:
+                headers['Content-Type'] = content_type
+            part = data.append(filedata, headers)
+            part.set_content_disposition('form-data', name = 'file', filename = filename)
+        r = await self._post('upload', data = data)
+        return _loads(r.content)['cid']
+
+    async def user_uploads(self, before: str = None, size: int = None):
+        '''
+        See API.user_uploads().
+        '''
+        r = await self._get(self._USER_UPLOADS_PATH, params=_user_uploads_params(before, size))
+        return _loads(r.content)
+
+    async def _head(self, path, **kwparams):
+        return await self._request(path, method='HEAD', **kwparams)
+    async def _get(self, path, **kwparams):
+        return await self._request(path, method='GET', **kwparams)
+    async def _post(self, path, **kwparams):
+        return await self._request(path, method='POST', **kwparams)
+    async def _request(self, path, method, **kwparams):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+                headers = self._headers
+            )
+        async with self._session.request(method, f'{self._url}/{path}', **kwparams) as r:
+            r = _AsyncResponse(r, await r.read())
         try:
             r.raise_for_status()
             return r
         except Exception as exception:
             http_exception = exception
-        if r.status_code == 400:
-            raise W3BadRequest(r)
-        elif r.status_code == 401:
-            raise W3Unauthorized(r)
-        elif r.status_code == 403:
-            raise W3Forbidden(r)
-        elif r.status_code >= 500 and r.status_code < 600:
-            raise W3InternalServerError(r)
+        _raise_w3_exception(r, http_exception)
+
+class _AsyncResponse:
+    '''
+    A read aiohttp response, presenting the parts of the requests.Response
+    interface that API and W3Exception make use of.
+    '''
+    def __init__(self, response, content):
+        self._response = response
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+class _ChunkedReader:
+    '''
+    Wraps a file-like request body so that it is sent in reads of
+    chunk_size, regardless of the size requested by the transport.
+
+    If reopen is given, it is called to produce a fresh body when rewinding
+    to the start.
+    '''
+    def __init__(self, fileobj, chunk_size = None, reopen = None):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._reopen = reopen
+        # requests reads this as the Content-Length; a body of unknown length
+        # leaves it None, and is sent with chunked transfer encoding instead
+        if hasattr(fileobj, 'len') or hasattr(fileobj, '__len__') or _seekable(fileobj):
+            self.len = requests.utils.super_len(fileobj)
+        else:
+            self.len = None
+        self._position = 0
+    def read(self, size = -1):
+        if self._chunk_size is not None:
+            size = self._chunk_size
+        data = self._fileobj.read(size)
+        self._position += len(data)
+        return data
+    def __iter__(self):
+        return iter(functools.partial(self.read, io.DEFAULT_BUFFER_SIZE), b'')
+    def tell(self):
+        return self._position
+    def seek(self, offset, whence = io.SEEK_SET):
+        # used to rewind the body for a retry; a body that cannot seek
+        # fails the retry rather than being resent truncated
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('seek')
+        if offset == 0 and self._reopen is not None:
+            self._fileobj = self._reopen()
+        elif hasattr(self._fileobj, 'seek'):
+            self._fileobj.seek(offset - self._position, io.SEEK_CUR)
+        else:
+            raise io.UnsupportedOperation('seek')
+        self._position = offset
+        return offset
+
+def _seekable(fileobj):
+    try:
+        return fileobj.seekable()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+def _multipart_reencoder(fields, encoder):
+    '''
+    Returns a function that rewinds the file objects in fields and encodes
+    them again as encoder did, or None if they cannot be rewound.
+    '''
+    streams = [
+        field[1][1]
+        for field in fields
+        if hasattr(field[1][1], 'read')
+    ]
+    try:
+        positions = [
+            (stream, stream.tell())
+            for stream in streams
+            if stream.seekable()
+        ]
+    except (AttributeError, OSError):
+        return None
+    if len(positions) < len(streams):
+        return None
+    def reencode():
+        for stream, position in positions:
+            stream.seek(position)
+        return MultipartEncoder(fields, boundary = encoder.boundary_value)
+    return reencode
+
+class _CompressedReader:
+    '''
+    Compresses a request body as it is read. The compressed length is not
+    known in advance, so the body is sent with chunked transfer encoding.
+
+    Rewinding to the start, as done for a retry, restarts compression if the
+    source can seek; otherwise it fails rather than resending a truncated
+    body.
+    '''
+    def __init__(self, fileobj, compress, chunk_size = None):
+        if not hasattr(fileobj, 'read'):
+            fileobj = io.BytesIO(fileobj)
+        self._fileobj = fileobj
+        self._compress = compress
+        self._chunk_size = chunk_size or io.DEFAULT_BUFFER_SIZE
+        try:
+            self._start = fileobj.tell() if fileobj.seekable() else None
+        except (AttributeError, OSError):
+            self._start = None
+        self._restart()
+    def _restart(self):
+        if self._compress == 'gzip':
+            self._compressor = zlib.compressobj(wbits = 16 + zlib.MAX_WBITS)
+        else:
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+        self._flushed = False
+        self._position = 0
+    def read(self, size = -1):
+        while not self._flushed:
+            chunk = self._fileobj.read(self._chunk_size)
+            if chunk:
+                data = self._compressor.compress(chunk)
+            else:
+                data = self._compressor.flush()
+                self._flushed = True
+            if data:
+                self._position += len(data)
+                return data
+        return b''
+    def __iter__(self):
+        return iter(self.read, b'')
+    def tell(self):
+        return self._position
+    def seek(self, offset, whence = io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET or self._start is None:
+            raise io.UnsupportedOperation('seek')
+        self._fileobj.seek(self._start)
+        self._restart()
+        return 0
+
+def _user_uploads_params(before, size):
+    params = {}
+    if before is not None:
+        if isinstance(before, (int, float)):
+            before = datetime.datetime.fromtimestamp(before, tz=datetime.timezone.utc).isoformat()
+        elif isinstance(before, datetime.datetime):
+            before = before.isoformat()
         else:
-            raise W3HTTPError(r, r.status_code, http_exception)
+            # strings are passed through as given
+            before = str(before)
+        params['before'] = before
+    if size is not None:
+        params['size'] = int(size)
+    return params
+
+def _raise_w3_exception(r, http_exception):
+    if r.status_code == 400:
+        raise W3BadRequest(r)
+    elif r.status_code == 401:
+        raise W3Unauthorized(r)
+    elif r.status_code == 403:
+        raise W3Forbidden(r)
+    elif r.status_code >= 500 and r.status_code < 600:
+        raise W3InternalServerError(r)
+    else:
+        raise W3HTTPError(r, r.status_code, http_exception)